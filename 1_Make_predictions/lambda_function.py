@@ -1,22 +1,52 @@
 from http import HTTPStatus
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from models_configuration import model_paths
 import os
 import time
+import io
 import json
-import pytz
+import orjson
 import boto3
 import joblib
 import requests
+import numpy as np
 import pandas as pd
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception
 
-def convert_gmt5_to_utc(gmt5_date):
-    utc_date = gmt5_date.astimezone(pytz.utc)
-    return utc_date
+try:
+    # Runtime hooks are only available on the Lambda managed runtimes with SnapStart
+    from snapshot_restore_py import register_after_restore
+except ImportError:
+    register_after_restore = None
+
+# Initialize S3 client once so warm invocations reuse its connection pool
+s3_client = boto3.client("s3", config=Config(max_pool_connections=10, tcp_keepalive=True))
+
+# Only use multipart uploads for files bigger than 64MB
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=64*1024*1024, use_threads=True)
+
+# Share one HTTP session so the login and the data requests reuse the same keep-alive connection
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+
+# Timeouts (in seconds) to connect to and read from the API
+REQUEST_TIMEOUT = (3, 20)
+
+def reset_connections():
+    # Connections opened before the snapshot are not valid after a restore
+    session.close()
+
+if register_after_restore:
+    register_after_restore(reset_connections)
 
 def get_start_end_of_day_in_utc():
-    # Define the GMT-5 timezone using pytz
-    gmt5 = pytz.timezone("Etc/GMT+5")
+    # Define the GMT-5 timezone using zoneinfo
+    gmt5 = ZoneInfo("Etc/GMT+5")
 
     # Get the current time in GMT-5
     gmt5_now = datetime.now(gmt5)
@@ -31,8 +61,8 @@ def get_start_end_of_day_in_utc():
     end_of_day_gmt5 = start_of_current_day_gmt5 - timedelta(days=0) - timedelta(seconds=1)
     
     # Convert both start and end times to UTC
-    start_of_day_utc = convert_gmt5_to_utc(start_of_day_gmt5)
-    end_of_day_utc = convert_gmt5_to_utc(end_of_day_gmt5)
+    start_of_day_utc = start_of_day_gmt5.astimezone(timezone.utc)
+    end_of_day_utc = end_of_day_gmt5.astimezone(timezone.utc)
     
     return start_of_day_utc, end_of_day_utc
 
@@ -53,63 +83,83 @@ def extract_token_from_response(json_response):
         print(f"An unexpected error occurred: {str(e)}")
         return None
 
-def request_with_retries(method, url, headers, data, max_retries=3, delay=2):
-    for attempt in range(1, max_retries + 1):
-        try:
-            if method == "POST":
-                response = requests.post(url, headers=headers, data=data)
-            elif method == "GET":
-                response = requests.get(url, headers=headers, data=data)
-            else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
-            
-            # Check if the response status code is 2xx (successful)
-            if 200 <= response.status_code < 300:
-                # Return the JSON response if successful
-                return response.json()
-            
-            # If the status code is not 200, raise an exception to retry
-            response.raise_for_status()
-        except (requests.exceptions.RequestException, ValueError) as e:
-            print(f"Attempt {attempt} failed: {e}")
-            
-            # If we've reached the max retries, return None
-            if attempt == max_retries:
-                print("Max retries reached. Returning None.")
-                return None
-            
-            print(f"Retrying in {delay} seconds...")
-            time.sleep(delay)
-
-def get_login_token(url, headers, data, max_retries=3, delay=2):
-    response_data = request_with_retries("POST", url, headers=headers, data=data, max_retries=max_retries, delay=delay)
+def is_retryable_error(e):
+    # Retry on rate limits (429) and server errors (5xx), but not on other 4xx errors like a failed login
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    # Retry on network issues and timeouts
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def get_deadline(context, margin=5):
+    # Stop some seconds before the Lambda timeout to leave time to finish the invocation
+    if context is None:
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - margin
+
+def deadline_reached(deadline):
+    return deadline is not None and time.monotonic() > deadline
+
+def stop_after_deadline(retry_state):
+    return deadline_reached(retry_state.kwargs.get("deadline"))
+
+# Retry settings: Exponential backoff with full jitter (up to 8s) and stops after 3 attempts or at the deadline
+@retry(
+    retry=retry_if_exception(is_retryable_error),
+    wait=wait_random_exponential(multiplier=0.5, max=8),
+    stop=(stop_after_attempt(3) | stop_after_deadline),  # Stop after 3 attempts
+    retry_error_callback=lambda retry_state: None # Return None after the final retry
+)
+def request_with_retries(method, url, headers, data, deadline=None):
+    if deadline_reached(deadline):
+        print("Deadline reached. Returning None.")
+        return None
+    try:
+        if method == "POST":
+            response = session.post(url, headers=headers, data=data, timeout=REQUEST_TIMEOUT)
+        elif method == "GET":
+            response = session.get(url, headers=headers, data=data, timeout=REQUEST_TIMEOUT)
+        else:
+            raise ValueError(f"Unsupported HTTP method: {method}")
+
+        # Raise an exception if the status code is not 2xx (successful)
+        response.raise_for_status()
+
+        # Return the JSON response if successful, orjson decodes the large payloads faster
+        return orjson.loads(response.content)
+    except requests.exceptions.RequestException as e:
+        if is_retryable_error(e):
+            print(f"Retrying due to error: {e}")
+            raise  # Reraises the exception to trigger the retry mechanism
+        print(f"Request failed: {e}")
+        return None
+    except ValueError as e:
+        print(f"Request failed: {e}")
+        return None
+
+def get_login_token(url, headers, data, deadline=None):
+    response_data = request_with_retries("POST", url, headers=headers, data=data, deadline=deadline)
     if response_data:
         return extract_token_from_response(response_data)
     return None
 
-def get_data_with_retries(url, headers, data, max_retries=3, delay=2):
-    response_data = request_with_retries("GET", url, headers=headers, data=data, max_retries=max_retries, delay=delay)
+def get_data_with_retries(url, headers, data, deadline=None):
+    response_data = request_with_retries("GET", url, headers=headers, data=data, deadline=deadline)
     if response_data:
         return response_data["data"]
     return None
 
 def process_data(records, column_mapping, model_columns, date_column):
-    df = pd.DataFrame(records)
-
-    # Rename columns
-    df.rename(columns=column_mapping, inplace=True)
-
-    # Convert the date column to datetime for proper sorting
-    df[date_column] = pd.to_datetime(df[date_column], format="%a, %d %b %Y %H:%M:%S GMT")
+    # Build the columns at once from the records, renaming them on the way
+    data = {column_mapping.get(column, column): [record.get(column) for record in records] for column in records[0]}
 
-    # Sort by the date column in ascending order
-    df.sort_values(by=date_column, ascending=True, inplace=True)
+    # Convert the date column to datetime and subtract the timedelta (in hours) to adjust to GMT-5
+    dates = pd.to_datetime(data.pop(date_column), format="%a, %d %b %Y %H:%M:%S GMT", cache=True) - pd.Timedelta(hours=5)
 
-    # Subtract the timedelta (in hours) from the date column to adjust to GMT-5
-    df[date_column] = df[date_column] - pd.Timedelta(hours=5)
+    # Sort by the date in ascending order
+    order = np.argsort(dates.asi8, kind="stable")
 
-    # Set the date column as the index
-    df.set_index(date_column, inplace=True)
+    # Set the date as the index
+    df = pd.DataFrame(data, index=dates.rename(date_column)).take(order)
 
     # Drop rows with missing values in the model_columns
     df.dropna(subset=model_columns, inplace=True)
@@ -142,17 +192,106 @@ def load_model(qhawax_id):
     model = grid_search.best_estimator_
     return model
 
-def upload_to_s3(local_file, bucket_name, s3_file_name):
-    s3 = boto3.client("s3")
+def load_models(model_paths):
+    models = dict()
+    for qhawax_id in model_paths:
+        try:
+            models[qhawax_id] = load_model(qhawax_id)
+        except Exception as e:
+            print(f"Error loading the model for qhawax_id {qhawax_id}: {e}")
+    return models
+
+# Load the pre-trained models once so warm invocations skip the unpickling
+models = load_models(model_paths)
+
+def get_model(qhawax_id):
+    # Fall back to loading the model from disk if it was not loaded at import time
+    if qhawax_id not in models:
+        models[qhawax_id] = load_model(qhawax_id)
+    return models[qhawax_id]
+
+def process_qhawax(qhawax_id, data_and_metadata, column_mapping, model_columns, date_column):
+    print(f"Processing qHAWAX {qhawax_id}")
+
+    records = data_and_metadata[0].get("data", None)
 
+    if not records: return None
+
+    # Process the records using the specified mappings and columns
+    df = process_data(records, column_mapping, model_columns, date_column)
+
+    if df.empty: return None
+
+    return qhawax_id, df
+
+def predict_group(model, group_dfs, model_columns):
+    # Stack the features (using the model_columns) of every dataframe in the group
+    x = pd.concat([df[model_columns] for df in group_dfs], axis=0)
+
+    # Predict the target values (Pm2.5) for the whole group in a single call
+    y_predicted = model.predict(x)
+
+    # Split the predictions back by the number of rows of each dataframe
+    split_points = np.cumsum([len(df) for df in group_dfs])[:-1]
+    for df, y in zip(group_dfs, np.split(y_predicted, split_points)):
+        # Assign the predicted values to the 'Prediccion_Pm2.5' column in the dataframe
+        df["Prediccion_Pm2.5"] = y
+
+def predict_by_model(executor, qhawax_dfs, model_columns):
+    # Group the dataframes that share the same model so each model predicts only once
+    groups = dict()
+    for qhawax_id, df in qhawax_dfs:
+        model = get_model(qhawax_id)
+        groups.setdefault(id(model), (model, list()))[1].append(df)
+
+    # The models are only read, so the groups can be predicted concurrently
+    futures = [executor.submit(predict_group, model, group_dfs, model_columns) for model, group_dfs in groups.values()]
+    for future in futures:
+        future.result()
+
+def combine_qhawax_dfs(qhawax_dfs, freq):
+    qhawax_ids = [qhawax_id for qhawax_id, _ in qhawax_dfs]
+
+    # Remove duplicated indexes, the mask is applied directly with loc
+    dfs = [df.loc[~df.index.duplicated(keep="first")] for _, df in qhawax_dfs]
+
+    # Create a complete date range with a frequency of 5 min for each qHAWAX
+    date_ranges = [pd.date_range(start=df.index.min(), end=df.index.max(), freq=freq) for df in dfs]
+
+    # Build the complete (qhawax_id, date) index of all the qHAWAX at once
+    complete_index = pd.MultiIndex.from_arrays([
+        np.repeat(qhawax_ids, [len(date_range) for date_range in date_ranges]),
+        np.concatenate([date_range.values for date_range in date_ranges])
+    ])
+
+    # Stack the dataframes by qhawax_id and reindex them once to fill in missing time slots
+    df = pd.concat(dfs, axis=0, keys=qhawax_ids).reindex(complete_index)
+
+    # Keep the dates as the index and set the 'qhawax_id' to avoid NaN values for this column
+    qhawax_id_values = df.index.get_level_values(0)
+    df.index = df.index.get_level_values(1)
+    df["qhawax_id"] = qhawax_id_values
+    return df
+
+def dataframe_to_parquet_buffer(df):
+    # Write the Parquet file into memory to avoid the round trip through /tmp
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, engine="pyarrow", compression="snappy")
+    buffer.seek(0)
+    return buffer
+
+def upload_to_s3(s3_client, file_obj, bucket_name, s3_file_name):
     # Upload the file
     try:
-        s3.upload_file(local_file, bucket_name, s3_file_name)
-        print(f"File {local_file} successfully uploaded to S3 bucket {bucket_name} as {s3_file_name}")
+        s3_client.upload_fileobj(file_obj, bucket_name, s3_file_name, Config=TRANSFER_CONFIG)
+        print(f"File successfully uploaded to S3 bucket {bucket_name} as {s3_file_name}")
     except Exception as e:
         print(f"Error uploading file to S3: {e}")
 
 def lambda_handler(event, context):
+    # Bound the total time spent on the requests by the remaining time of the invocation
+    deadline = get_deadline(context)
+
     start_date, end_date = get_start_end_of_day_in_utc()
     start_date_formatted, end_date_formatted = format_datetime(start_date), format_datetime(end_date)
 
@@ -172,7 +311,7 @@ def lambda_handler(event, context):
         "password": password
     })
 
-    token = get_login_token(login_url, headers, data)
+    token = get_login_token(login_url, headers, data, deadline)
 
     if token is None:
         print("Failed to get login token, aborting.")
@@ -188,7 +327,7 @@ def lambda_handler(event, context):
     }
     data = {}
 
-    response_data = get_data_with_retries(url, headers, data)
+    response_data = get_data_with_retries(url, headers, data, deadline)
     if response_data is None:
         print("Failed to get sensors data, aborting.")
         return
@@ -202,8 +341,6 @@ def lambda_handler(event, context):
     #     response_data = json.load(json_file)
     ################################################################################################################################
 
-    dfs = list()
-
     qhawax_ids_with_models = {"qH013", "qH014", "qH015", "qH017", "qH018"}
     column_mapping = {
         "PM25": "Pm2.5",
@@ -215,66 +352,36 @@ def lambda_handler(event, context):
     date_column = "timestamp_zone"
     freq = "5min"
 
-    # Iterate through each qHAWAX key in the original dictionary
-    for qhawax_id, data_and_metadata in response_data.items():
-        if qhawax_id not in qhawax_ids_with_models: continue
-
-        print(f"Processing qHAWAX {qhawax_id}")
-
-        records = data_and_metadata[0].get("data", None)
-        
-        if not records: continue
-
-        # Process the records using the specified mappings and columns
-        df = process_data(records, column_mapping, model_columns, date_column)
-
-        # Load the pre-trained model for the current qhawax_id
-        model = load_model(qhawax_id)
+    items = [(qhawax_id, data_and_metadata) for qhawax_id, data_and_metadata in response_data.items() if qhawax_id in qhawax_ids_with_models]
 
-        # Extract the features for prediction (using the model_columns)
-        x = df[model_columns]
-        
-        # Predict the target values (Pm2.5) using the loaded model
-        y_predicted = model.predict(x)
+    # Process each qHAWAX concurrently, pandas and scikit-learn release the GIL on the heavy operations
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = executor.map(lambda item: process_qhawax(*item, column_mapping, model_columns, date_column), items)
+        qhawax_dfs = [result for result in results if result is not None]
 
-        # Assign the predicted values to the 'Prediccion_Pm2.5' column in the dataframe
-        df["Prediccion_Pm2.5"] = y_predicted
-        
-        # Remove duplicated indexes
-        df = df[~df.index.duplicated(keep="first")]
-
-        # Create a complete date range for the index with a frequency of 5 min
-        complete_index = pd.date_range(start=df.index.min(), end=df.index.max(), freq=freq)
-        
-        # Reindex the dataframe to the complete date range to fill in missing time slots
-        df = df.reindex(complete_index)
-
-        # Set the 'qhawax_id' to avoid NaN values for this column
-        df["qhawax_id"] = qhawax_id
+        # Predict all the qHAWAX at once, batching the rows of the ones that share a model
+        predict_by_model(executor, qhawax_dfs, model_columns)
 
-        # Append the processed dataframe for the current qhawax_id to the list of dataframes
-        dfs.append(df)
+    if not qhawax_dfs:
+        print("No sensors data to predict, aborting.")
+        return
 
-    # Concatenate all dataframes
-    final_df = pd.concat(dfs, axis=0, ignore_index=False)
+    # Concatenate all dataframes, filling in the missing time slots of each qHAWAX with a single reindex
+    final_df = combine_qhawax_dfs(qhawax_dfs, freq)
 
     final_df = final_df.drop("id", axis=1)
 
     # Use only the year, month, and day from start_date
-    file_name = f"{start_date.year}_{start_date.month:02d}_{start_date.day:02d}_{freq}_prediction.csv"
-    file_path = f"/tmp/{file_name}"
-    final_df.to_csv(file_path)
+    file_name = f"{start_date.year}_{start_date.month:02d}_{start_date.day:02d}_{freq}_prediction.parquet"
+    parquet_buffer = dataframe_to_parquet_buffer(final_df)
 
-    print(f"Data with predictions saved to {file_path}")
+    print(f"Data with predictions serialized as {file_name}")
 
     bucket_name = "air-quality-predictions"
 
-    # The filename on S3 will be the same as the local filename
+    # The filename on S3 will be the same as the file name
     s3_file_name = file_name
 
     # Upload the file to S3
-    upload_to_s3(file_path, bucket_name, s3_file_name)
-
-    # Remove the local file after upload
-    os.remove(file_path)
+    upload_to_s3(s3_client, parquet_buffer, bucket_name, s3_file_name)
 # lambda_handler({}, None)
\ No newline at end of file
@@ -1,15 +1,20 @@
 import re
 import os
 import io
+import socket
 import boto3
+import numpy as np
 import pandas as pd
 from http import HTTPStatus
-from datetime import timedelta, datetime
+from datetime import datetime
 from google.oauth2 import service_account
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
+from concurrent.futures import ThreadPoolExecutor
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
 # Path to your credentials JSON file (Downloaded from Google Cloud)
@@ -22,13 +27,20 @@ FOLDER_ID = os.environ.get("FOLDER_ID", "")
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 creds = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
 
+# Default timeout (in seconds) for the sockets of the Google Drive client, which does not set one
+socket.setdefaulttimeout(30)
+
 # Retry on multiple exceptions: network issues, API errors, IO errors
 DOWNLOAD_RETRY_EXCEPTIONS = (HttpError, IOError, ConnectionError, TimeoutError)
 
 # Initialize Google Drive API client
 drive_service = build("drive", "v3", credentials=creds)
 
-s3_client = boto3.client("s3")
+# Allow enough pooled connections for the concurrent uploads
+s3_client = boto3.client("s3", config=Config(max_pool_connections=32))
+
+# Only use multipart uploads for files bigger than 64MB
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=64*1024*1024, use_threads=True)
 
 def get_latest_subfolder_id(parent_id):
     query = f"'{parent_id}' in parents and mimeType='application/vnd.google-apps.folder'"
@@ -107,60 +119,55 @@ def download_excel_file(drive_service, file_id):
         print(f"Unexpected Error: {e}")
         return None
 
-def read_csv_file(file_stream):
-    df = pd.read_csv(file_stream, sep=", ", engine="python")
+def read_csv_file(file_stream, columns_to_keep=None):
+    # The C engine with skipinitialspace handles the ", " separator, only the needed columns are parsed
+    usecols = (lambda column: column.strip() in columns_to_keep) if columns_to_keep else None
+    df = pd.read_csv(file_stream, sep=",", skipinitialspace=True, usecols=usecols, engine="c")
     return df
 
 def set_date_column_as_index(df, date_column, date_format, date_offset=None):
-    df[date_column] = pd.to_datetime(df[date_column], format=date_format)
+    # cache=True parses each unique date string only once
+    df[date_column] = pd.to_datetime(df[date_column], format=date_format, cache=True)
     if date_offset:
         # Subtract the timedelta (in hours) from the date column to adjust for any time shift
         df[date_column] = df[date_column] - pd.Timedelta(hours=date_offset)
     df.set_index(date_column, inplace=True)
     return df
 
-def get_column_to_remove_nulls(df, columns_processed, n_consecutive_dates):
-    df_nulls_per_column = df.drop(columns_processed, axis=1).isna().sum().sort_values(ascending=False)
+def get_columns_to_remove_nulls(df_nulls, n_consecutive_dates):
+    df_nulls_per_column = df_nulls.sum().sort_values(ascending=False)
     df_nulls_per_column = df_nulls_per_column[df_nulls_per_column >= n_consecutive_dates]
-    column_with_most_nulls = None
-    column_nulls = None
-    if len(df_nulls_per_column) > 0:
-        column_with_most_nulls = df_nulls_per_column.index[0]
-        column_nulls = df_nulls_per_column.iloc[0]
-    return column_with_most_nulls, column_nulls
+    return df_nulls_per_column
 
 def consecutive_records(dates_dt, timedelta_min, n_consecutive_dates):
-    segments = list()
-    current_segment = [dates_dt[0]]
-    for i in range(1, len(dates_dt)):
-        if (dates_dt[i] - dates_dt[i - 1]) == timedelta(minutes=timedelta_min):
-            current_segment.append(dates_dt[i])
-        else:
-            if len(current_segment) >= n_consecutive_dates:
-                segments.extend(current_segment)
-            current_segment = [dates_dt[i]]
-    if len(current_segment) >= n_consecutive_dates:
-        segments.extend(current_segment)
-    return segments
-
-def remove_nulls(df, column, timedelta_min, n_consecutive_dates):
-    null_indices = df.index[df[column].isna()]
-    if len(null_indices) >= n_consecutive_dates:
-        indices_to_remove = consecutive_records(null_indices, timedelta_min, n_consecutive_dates)
-        df = df.drop(indices_to_remove, axis=0)
-    return df
+    # Positions where the gap with the previous date breaks the sequence
+    gaps = np.diff(dates_dt.values) != np.timedelta64(timedelta_min, "m")
+    breaks = np.flatnonzero(gaps) + 1
+    # Length of each run of consecutive dates
+    lengths = np.diff(np.r_[0, breaks, len(dates_dt)])
+    # Keep only the dates that belong to runs of n_consecutive_dates or more
+    mask = np.repeat(lengths >= n_consecutive_dates, lengths)
+    return dates_dt[mask]
+
+def get_null_indices_to_remove(df, df_nulls, column, timedelta_min, n_consecutive_dates):
+    null_indices = df.index[df_nulls[column].values]
+    return consecutive_records(null_indices, timedelta_min, n_consecutive_dates)
 
 def apply_remove_nulls(df, n_consecutive_dates, timedelta_min):
-    columns_processed = set()
     print(f"Before removing nulls the shape is {df.shape}.")
-    for _ in range(len(df.columns)):
-        column_with_most_nulls, column_nulls = get_column_to_remove_nulls(df, columns_processed, n_consecutive_dates)
-        if column_with_most_nulls is None:
-            return df
-        df = remove_nulls(df, column_with_most_nulls, timedelta_min, n_consecutive_dates)
-        columns_processed.add(column_with_most_nulls)
-        print(f"'{column_with_most_nulls}' had {column_nulls} nulls, 'remove_nulls' was applied.")
-        print(f"---> After removing nulls the shape is {df.shape}.")
+    # Compute the nulls once, the runs of every column are found on the same frame
+    df_nulls = df.isna()
+    df_nulls_per_column = get_columns_to_remove_nulls(df_nulls, n_consecutive_dates)
+    if len(df_nulls_per_column) == 0:
+        return df
+    indices_to_remove = pd.DatetimeIndex([])
+    for column, column_nulls in df_nulls_per_column.items():
+        column_indices = get_null_indices_to_remove(df, df_nulls, column, timedelta_min, n_consecutive_dates)
+        indices_to_remove = indices_to_remove.union(column_indices)
+        print(f"'{column}' had {column_nulls} nulls, 'remove_nulls' was applied.")
+    # Drop the rows of all the columns in a single pass
+    df = df.drop(indices_to_remove, axis=0)
+    print(f"---> After removing nulls the shape is {df.shape}.")
     return df
 
 def interpolate_nulls(df):
@@ -173,10 +180,11 @@ def interpolate_nulls(df):
 
 def process_dataframe(df, columns_to_keep, standard_date_column, date_format, freq):
     df.columns = df.columns.str.strip()
-    df = df[columns_to_keep].copy()
-    df.drop_duplicates(subset=[standard_date_column], keep="first", inplace=True)
+    df = df[columns_to_keep]
+    # Deduplicate on the raw date column before it is parsed and set as the index
+    df = df[~df[standard_date_column].duplicated(keep="first")].copy()
     df = set_date_column_as_index(df, standard_date_column, date_format) # The date is in GTM-5
-    df = df.apply(pd.to_numeric, errors="coerce")
+    df = pd.DataFrame({column: pd.to_numeric(df[column], errors="coerce") for column in df.columns}, index=df.index)
     df.dropna(axis=0, inplace=True)
     # Resample to 1min to standardize the data
     df = df.resample("1min").mean()
@@ -199,34 +207,59 @@ def download_file_from_s3(s3_client, local_path, bucket_name, s3_file_name):
     except Exception as e:
         return None
 
+def dataframe_to_parquet_buffer(df):
+    # Write the Parquet file into memory to avoid the round trip through /tmp
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, engine="pyarrow", compression="snappy")
+    buffer.seek(0)
+    return buffer
+
+def upload_to_s3(s3_client, file_obj, bucket_name, s3_file_name):
+    # Upload the file
+    try:
+        s3_client.upload_fileobj(file_obj, bucket_name, s3_file_name, Config=TRANSFER_CONFIG)
+        print(f"File successfully uploaded to S3 bucket {bucket_name} as {s3_file_name}")
+    except Exception as e:
+        print(f"Error uploading file to S3: {e}")
+
 # Retry settings: Exponential backoff (1s, 2s, 4s, ...) and stops after 5 attempts
 @retry(
     retry=retry_if_exception_type(ClientError),
     wait=wait_exponential(multiplier=1, min=1, max=10),  # Exponential backoff delay=max(min(multiplier×2^n,max),min)
     stop=stop_after_attempt(5),  # Stop after 5 retries
-    retry_error_callback=lambda retry_state: False # Assume the file does not exist after the final retry
+    retry_error_callback=lambda retry_state: None # Skip the file after the final retry
 )
-def file_exists(s3_client, bucket, key):
+def upload_to_s3_if_not_exists(s3_client, file_obj, bucket_name, s3_file_name):
+    # Conditional write, S3 only stores the file if the key does not exist yet
     try:
-        s3_client.head_object(Bucket=bucket, Key=key)
-        return True  # File exists
+        s3_client.put_object(Bucket=bucket_name, Key=s3_file_name, Body=file_obj.getvalue(), IfNoneMatch="*")
+        print(f"File successfully uploaded to S3 bucket {bucket_name} as {s3_file_name}")
     except ClientError as e:
-        if e.response["Error"]["Code"] == "404":
-            return False  # File does not exist
+        if e.response["Error"]["Code"] == "PreconditionFailed":
+            print(f"File {s3_file_name} already exists, skipping upload.")
+            return
         print(f"Retrying due to error: {e}")
         raise  # Some other error occurred. Reraises the exception to trigger the retry mechanism
-    except Exception as e:
-        print(f"Error searching the file {key} in the bucket: {e}")
-        return False # Assume the file does not exist
-
-def upload_to_s3(s3_client, local_file, bucket_name, s3_file_name):
-    # Upload the file
-    try:
-        s3_client.upload_file(local_file, bucket_name, s3_file_name)
-        print(f"File {local_file} successfully uploaded to S3 bucket {bucket_name} as {s3_file_name}")
     except Exception as e:
         print(f"Error uploading file to S3: {e}")
 
+def upload_group(s3_client, bucket_name, date, group, freq, is_last):
+    # Use only the year, month, and day
+    file_name = f"{date.year}_{date.month:02d}_{date.day:02d}_{freq}_prediction.parquet"
+    parquet_buffer = dataframe_to_parquet_buffer(group)
+
+    print(f"Teledyne data serialized as {file_name}")
+
+    # The filename on S3 will be the same as the file name
+    s3_file_name = file_name
+
+    if not is_last:
+        # Upload the file to S3 only if it does not exist
+        upload_to_s3_if_not_exists(s3_client, parquet_buffer, bucket_name, s3_file_name)
+    else:
+        # Upload the file to S3
+        upload_to_s3(s3_client, parquet_buffer, bucket_name, s3_file_name)
+
 def lambda_handler(event, context):
     # Only get Excel files containing "PUCP"
     file_pattern = "PUCP"
@@ -256,12 +289,9 @@ def lambda_handler(event, context):
             print(f"The latest subfolder is still {subfolder_name}")
             return
 
-    file_path = f"{local_path}/{s3_file_name}"
+    file_obj = io.BytesIO((subfolder_name + "\n").encode("utf-8"))
 
-    with open(file_path, "w") as file_obj:
-        file_obj.write(subfolder_name + "\n")
-
-    upload_to_s3(s3_client, file_path, bucket_name, s3_file_name)
+    upload_to_s3(s3_client, file_obj, bucket_name, s3_file_name)
 
     print(f"Downloading latest matching file {file_name} from subfolder {subfolder_name}")
     file_stream = download_excel_file(drive_service, file_id)
@@ -272,7 +302,7 @@ def lambda_handler(event, context):
 
     print(f"Download finished")
     
-    df = read_csv_file(file_stream)
+    df = read_csv_file(file_stream, columns_to_keep)
 
     print(f"Excel file loaded as DataFrame")
 
@@ -284,31 +314,11 @@ def lambda_handler(event, context):
     num_groups = groups.ngroups
 
     # Group by only the date (year-month-day)
-    for i, (date, group) in enumerate(groups):
-        # Use only the year, month, and day
-        file_name = f"{date.year}_{date.month:02d}_{date.day:02d}_{freq}_prediction.csv"
-        file_path = f"{local_path}/{file_name}"
-        group.to_csv(file_path)
-
-        print(f"Teledyne data saved to {file_path}")
-
-        # The filename on S3 will be the same as the local filename
-        s3_file_name = file_name
-
-        is_last = (i == num_groups - 1)
-
-        if not is_last:
-            s3_file_name_exists = file_exists(s3_client, bucket_name, s3_file_name)
-
-            if not s3_file_name_exists:
-                # Upload the file to S3
-                upload_to_s3(s3_client, file_path, bucket_name, s3_file_name)
-            else:
-                print(f"File {s3_file_name} already exists, skipping upload.")
-        else:
-            # Upload the file to S3
-            upload_to_s3(s3_client, file_path, bucket_name, s3_file_name)
+    items = [(date, group, i == num_groups - 1) for i, (date, group) in enumerate(groups)]
 
-        # Remove the local file after upload
-        os.remove(file_path)
+    # The uploads are I/O bound, so upload the days concurrently
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        futures = [executor.submit(upload_group, s3_client, bucket_name, date, group, freq, is_last) for date, group, is_last in items]
+        for future in futures:
+            future.result()
 # lambda_handler({}, None)
\ No newline at end of file
@@ -1,5 +1,6 @@
 from http import HTTPStatus
 import datetime
+import hmac
 import json
 import jwt
 import os
@@ -7,16 +8,29 @@ import os
 EMAIL = os.getenv("EMAIL")
 PASSWORD = os.getenv("PASSWORD")
 
+# Encode the credentials once to compare them as bytes
+EMAIL_BYTES = EMAIL.encode("utf-8") if EMAIL is not None else None
+PASSWORD_BYTES = PASSWORD.encode("utf-8") if PASSWORD is not None else None
+
 # Secret key for encoding and decoding the JWT
 SECRET_KEY = os.getenv("JWT_SECRET")
 
+# Encode the secret key once instead of on every signature
+SECRET_KEY_BYTES = SECRET_KEY.encode("utf-8") if SECRET_KEY is not None else None
+
+def is_valid_credential(value, expected):
+    """Compares the credential in constant time to avoid leaking timing information."""
+    if not isinstance(value, str) or expected is None:
+        return False
+    return hmac.compare_digest(value.encode("utf-8"), expected)
+
 def generate_token(email):
     """Generates a JWT token valid for 1 min."""
     payload = {
         "email": email,
-        "exp": (datetime.datetime.utcnow() + datetime.timedelta(minutes=1)).timestamp()
+        "exp": (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=1)).timestamp()
     }
-    return jwt.encode(payload, SECRET_KEY, algorithm="HS256")
+    return jwt.encode(payload, SECRET_KEY_BYTES, algorithm="HS256")
 
 def lambda_handler(event, context):
     """Handles user authentication and returns a JWT token."""
@@ -26,7 +40,8 @@ def lambda_handler(event, context):
         email = body.get("email")
         password = body.get("password")
 
-        if email == EMAIL and password == PASSWORD:
+        # Evaluate both comparisons so the response time does not depend on which one failed
+        if is_valid_credential(email, EMAIL_BYTES) & is_valid_credential(password, PASSWORD_BYTES):
             token = generate_token(email)
             return {
                 "statusCode": HTTPStatus.OK,
@@ -1,74 +1,289 @@
+import numpy as np
 import pandas as pd
+from pyarrow import csv as pacsv
 import boto3
 import json
 import jwt
 import os
+import time
+import hmac
+import base64
+import hashlib
 import io
 
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import defaultdict
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from http import HTTPStatus
 
+try:
+    # orjson parses and serializes large payloads faster than the standard library
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
 # Secret key for decoding the JWT
 SECRET_KEY = os.getenv("JWT_SECRET")
 
-# Initialize S3 client
-s3_client = boto3.client("s3")
+# HMAC-SHA256 initialized once with the secret key, it is copied to verify each token
+SECRET_KEY_HMAC = hmac.new(SECRET_KEY.encode("utf-8"), digestmod=hashlib.sha256) if SECRET_KEY is not None else None
 
-def verify_token(token):
-    """Verifies the JWT token."""
+# Verify the tokens with PyJWT instead of the precomputed HMAC
+USE_PYJWT = os.getenv("USE_PYJWT", "false").lower() == "true"
+
+# Initialize S3 client at module scope, with enough pooled connections for the concurrent reads
+s3_client = boto3.client("s3", config=Config(
+    max_pool_connections=64,
+    retries={"mode": "adaptive", "max_attempts": 3},
+    tcp_keepalive=True
+))
+
+# Date ranges up to this number of days are listed with one request per day instead of a paginated scan
+MAX_DAYS_LISTED_PER_DAY = 31
+
+# S3 Select is not available for AWS accounts created after July 2024, so it must be enabled explicitly
+USE_S3_SELECT = os.getenv("USE_S3_SELECT", "false").lower() == "true"
+
+# Maximum number of days of a query, larger date ranges are rejected before reading from S3
+MAX_DAYS = int(os.getenv("MAX_DAYS", "366"))
+
+# Number of threads used by each query to list and read the S3 files
+PER_QUERY_CONCURRENCY = int(os.getenv("PER_QUERY_CONCURRENCY", "16"))
+
+def base64url_decode(data):
+    """Decodes a base64url segment of the JWT, restoring the stripped padding."""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def get_int_claim(payload, claim):
+    """Returns the claim converted to an integer as PyJWT does, or None if it is not an integer."""
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        return int(payload[claim])
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+def validate_time_claims(payload):
+    """Checks the iat, nbf and exp claims of the JWT payload (when present) as PyJWT does."""
+    now = time.time()
+
+    # The token is not valid yet if it was issued or starts in the future
+    for claim in ("iat", "nbf"):
+        if claim in payload:
+            value = get_int_claim(payload, claim)
+            if value is None or value > now:
+                return {"error": "Invalid token"}
+
+    if "exp" in payload:
+        exp = get_int_claim(payload, "exp")
+        if exp is None:
+            return {"error": "Invalid token"}
+        if exp <= now:
+            return {"error": "Token has expired"}
+
+    return payload
+
+def verify_token_hmac(token):
+    """Verifies the signature and the time independent claims of the HS256 JWT token with the precomputed HMAC."""
+    if SECRET_KEY_HMAC is None:
+        return {"error": "Invalid token"}
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+
+        # Check the signature before decoding any JSON
+        signature_hmac = SECRET_KEY_HMAC.copy()
+        signature_hmac.update(f"{header_b64}.{payload_b64}".encode("ascii"))
+        if not hmac.compare_digest(signature_hmac.digest(), base64url_decode(signature_b64)):
+            return {"error": "Invalid token"}
+
+        header = json_loads(base64url_decode(header_b64))
+        payload = json_loads(base64url_decode(payload_b64))
+    except (ValueError, UnicodeEncodeError):
+        return {"error": "Invalid token"}
+
+    if not isinstance(header, dict) or header.get("alg") != "HS256" or not isinstance(payload, dict):
+        return {"error": "Invalid token"}
+
+    # Check the sub, jti and aud claims as PyJWT does, no audience is expected so any aud is rejected
+    if "sub" in payload and not isinstance(payload["sub"], str):
+        return {"error": "Invalid token"}
+    if "jti" in payload and not isinstance(payload["jti"], str):
+        return {"error": "Invalid token"}
+    if payload.get("aud"):
+        return {"error": "Invalid token"}
+
+    return payload  # Returns the decoded payload if valid
+
+def decode_token(token):
+    """Decodes and verifies the JWT token, except for the time claims checked by verify_token."""
+    if not USE_PYJWT:
+        return verify_token_hmac(token)
+    try:
+        payload = jwt.decode(
+            token,
+            SECRET_KEY,
+            algorithms=["HS256"],
+            options={"verify_exp": False, "verify_nbf": False, "verify_iat": False}
+        )
         return payload  # Returns the decoded payload if valid
-    except jwt.ExpiredSignatureError:
-        return {"error": "Token has expired"}
     except jwt.InvalidTokenError:
         return {"error": "Invalid token"}
 
-def get_data_as_dataframe(s3_client, bucket_name, start_filename, start_date, end_date, columns_to_keep):
-    # List all objects in the S3 bucket, starting after the start_filename
-    response = s3_client.list_objects_v2(
+@lru_cache(maxsize=1024)
+def decode_token_cached(token):
+    """Decodes the JWT token once per token, the payload is cached as a tuple of items."""
+    return tuple(decode_token(token).items())
+
+def verify_token(token):
+    """Verifies the JWT token."""
+    payload = dict(decode_token_cached(token))
+    if "error" in payload:
+        return payload
+    # The time claims are checked on every call, the cached token may have expired or become valid since it was first verified
+    return validate_time_claims(payload)
+
+def read_file(file_name, file_content, columns_to_keep):
+    if file_name.endswith(".parquet"):
+        # Read only the relevant columns, the datetime index is restored from the Parquet metadata
+        return pd.read_parquet(io.BytesIO(file_content), columns=columns_to_keep)
+    # The first column of the CSV is the datetime index, usually without a name
+    index_column = file_content.split(b"\n", 1)[0].split(b",", 1)[0].decode("utf-8").strip()
+    # Read CSV with the multi-threaded PyArrow reader, materializing only the relevant columns
+    table = pacsv.read_csv(
+        io.BytesIO(file_content),
+        read_options=pacsv.ReadOptions(use_threads=True),
+        convert_options=pacsv.ConvertOptions(include_columns=[index_column] + columns_to_keep)
+    )
+    df = table.to_pandas()
+    # Parse the first column as datetime, and set it as the index
+    df.index = pd.DatetimeIndex(pd.to_datetime(df.pop(index_column), cache=True).rename(None))
+    return df[columns_to_keep]
+
+def select_csv_file(s3_client, bucket_name, file_name, columns_to_keep):
+    # Let S3 project the columns, the first column (the datetime index) is referenced by position
+    columns = ", ".join(f's."{column}"' for column in columns_to_keep)
+    response = s3_client.select_object_content(
+        Bucket=bucket_name,
+        Key=file_name,
+        ExpressionType="SQL",
+        Expression=f"SELECT s._1, {columns} FROM S3Object s",
+        InputSerialization={"CSV": {"FileHeaderInfo": "USE"}},
+        OutputSerialization={"CSV": {}}
+    )
+    # Accumulate the streamed records of the projected result
+    buffer = io.BytesIO()
+    for event in response["Payload"]:
+        if "Records" in event:
+            buffer.write(event["Records"]["Payload"])
+    buffer.seek(0)
+    # Read the projected CSV, which has no header, and set the datetime as the index
+    df = pd.read_csv(buffer, sep=",", header=None, names=["date"] + columns_to_keep, index_col=0, parse_dates=True)
+    df.index.name = None
+    return df
+
+def read_s3_file(s3_client, bucket_name, file_name, columns_to_keep):
+    df = None
+    if USE_S3_SELECT and file_name.endswith(".csv"):
+        try:
+            df = select_csv_file(s3_client, bucket_name, file_name, columns_to_keep)
+        except ClientError as e:
+            print(f"S3 Select failed for {file_name}, reading the whole file: {e}")
+
+    if df is None:
+        # Read the file from S3 into a pandas dataframe
+        s3_file = s3_client.get_object(Bucket=bucket_name, Key=file_name)
+        file_content = s3_file["Body"].read()
+
+        df = read_file(file_name, file_content, columns_to_keep)
+
+    # Keep the index (which is datetime) as the 'date' column, it is formatted once all files are combined
+    return df.assign(date=df.index)
+
+def get_common_prefix(start_date, end_date):
+    # Longest shared prefix of the file names in the date range (e.g. 'YYYY_' or 'YYYY_MM_')
+    return os.path.commonprefix([start_date.strftime("%Y_%m_%d"), end_date.strftime("%Y_%m_%d")])
+
+def list_file_names(s3_client, bucket_name, prefix, start_filename):
+    # List all objects in the S3 bucket with the prefix, starting after the start_filename
+    paginator = s3_client.get_paginator("list_objects_v2")
+    pages = paginator.paginate(
         Bucket=bucket_name,
+        Prefix=prefix,  # Let S3 filter the files outside the date range
         StartAfter=start_filename  # Start listing after this filename
     )
-    
-    # Prepare a list to store results
-    results = list()
+    # Yield the file names page by page
+    for page in pages:
+        yield [obj["Key"] for obj in page.get("Contents", list())]
 
-    # Loop over the files in the bucket
-    for obj in response.get("Contents", list()):
-        file_name = obj["Key"]
+def list_day_file_names(s3_client, bucket_name, day_prefix):
+    # A day has only a few files, so a single request lists all of them
+    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=day_prefix)
+    return [obj["Key"] for obj in response.get("Contents", list())]
 
-        if not file_name.endswith(".csv"): continue
-        
-        # Extract the date from the file name (assuming the format is 'YYYY_MM_DD_5min_prediction.csv')
-        try:
-            file_date_str = file_name.split("_")[0:3]
-            file_date = datetime.strptime("-".join(file_date_str), "%Y-%m-%d")
-        except Exception as e:
-            continue
-        
-        # Check if the file is within the specified date range
-        if start_date <= file_date <= end_date:
-            # Read the CSV file from S3 into a pandas dataframe
-            csv_file = s3_client.get_object(Bucket=bucket_name, Key=file_name)
-            file_content = csv_file["Body"].read()
-            
-            # Read CSV into dataframe, parse the first column as datetime, and set it as the index
-            df = pd.read_csv(io.BytesIO(file_content), sep=",", index_col=0, parse_dates=True)
-            
-            # Extract the relevant columns
-            df_filtered = df[columns_to_keep].copy()
-            
-            # Use the index (which is datetime) as the 'date' column
-            df_filtered["date"] = df.index.strftime("%d-%m-%Y %H:%M:%S")
-            
-            # Append to the results list
-            results.append(df_filtered)
+def list_file_names_per_day(s3_client, bucket_name, start_date, end_date):
+    # One prefix per day of the date range (e.g. 'YYYY_MM_DD')
+    day_prefixes = [day.strftime("%Y_%m_%d") for day in pd.date_range(start_date, end_date, freq="D")]
+    # List the days concurrently, the results are yielded in ascending order
+    with ThreadPoolExecutor(max_workers=PER_QUERY_CONCURRENCY) as executor:
+        yield from executor.map(lambda day_prefix: list_day_file_names(s3_client, bucket_name, day_prefix), day_prefixes)
+
+def get_data_as_dataframe(s3_client, bucket_name, start_filename, start_date, end_date, columns_to_keep):
+    if (end_date - start_date).days < MAX_DAYS_LISTED_PER_DAY:
+        # Short date ranges are listed with a small request per day
+        file_name_pages = list_file_names_per_day(s3_client, bucket_name, start_date, end_date)
+    else:
+        file_name_pages = list_file_names(s3_client, bucket_name, get_common_prefix(start_date, end_date), start_filename)
+
+    # Files to read per date, the Parquet files replace the older CSV files of the same date
+    files_per_date = dict()
+
+    # Loop over the files in the bucket, which are listed in ascending order
+    for page_file_names in file_name_pages:
+        file_names = pd.Series([file_name for file_name in page_file_names if file_name.endswith((".csv", ".parquet"))], dtype=object)
+
+        if file_names.empty: continue
+
+        # Extract the dates from the file names at once (assuming the format is 'YYYY_MM_DD_5min_prediction.parquet')
+        file_dates = pd.to_datetime(file_names.str[:10].str.replace("_", "-", regex=False), format="%Y-%m-%d", errors="coerce", cache=True)
+
+        # Check if the files are within the specified date range
+        in_range = (file_dates >= start_date) & (file_dates <= end_date)
+
+        for file_date, file_name in zip(file_dates[in_range], file_names[in_range]):
+            if file_date not in files_per_date or file_name.endswith(".parquet"):
+                files_per_date[file_date] = file_name
+
+        # The remaining files are after the date range
+        if (file_dates > end_date).any(): break
+
+    # Sort the files by date to keep the results in order
+    file_names = [files_per_date[file_date] for file_date in sorted(files_per_date)]
+
+    # Download and read the files concurrently, the requests to S3 are network bound
+    with ThreadPoolExecutor(max_workers=PER_QUERY_CONCURRENCY) as executor:
+        results = list(executor.map(lambda file_name: read_s3_file(s3_client, bucket_name, file_name, columns_to_keep), file_names))
 
     final_results = None
     if len(results) > 0:
-        # Concatenate all dataframes into one
-        final_results = pd.concat(results, axis=0, ignore_index=True)
+        # Collect the arrays of each column to concatenate them once per column
+        chunks = defaultdict(list)
+        for df in results:
+            for column in df.columns:
+                chunks[column].append(df[column].to_numpy())
+
+        # Build the final dataframe directly from the concatenated arrays
+        final_results = pd.DataFrame({column: np.concatenate(arrays) for column, arrays in chunks.items()})
         final_results.drop_duplicates(keep="first", inplace=True)
 
     return final_results
@@ -83,7 +298,7 @@ def lambda_handler(event, context):
         if not auth_header or not auth_header.startswith("Bearer "):
             return {
                 "statusCode": HTTPStatus.UNAUTHORIZED,
-                "body": json.dumps({"message": "Missing or invalid Authorization header"})
+                "body": json_dumps({"message": "Missing or invalid Authorization header"})
             }
 
         token = auth_header.split(" ")[1]
@@ -92,15 +307,15 @@ def lambda_handler(event, context):
         if "error" in decoded_payload:
             return {
                 "statusCode": HTTPStatus.UNAUTHORIZED,
-                "body": json.dumps(decoded_payload)
+                "body": json_dumps(decoded_payload)
             }
 
         try:
-            body = json.loads(event.get("body", "{}"))
+            body = json_loads(event.get("body", "{}"))
         except json.JSONDecodeError:
             return {
                 "statusCode": HTTPStatus.BAD_REQUEST,
-                "body": json.dumps({"message": "Invalid JSON format in request body"})
+                "body": json_dumps({"message": "Invalid JSON format in request body"})
             }
 
         # Get the start and end date
@@ -132,6 +347,13 @@ def lambda_handler(event, context):
                 "body": {"message": "The end_date must be greater than or equal to start_date."}
             }
 
+        # Reject the date ranges too large to be returned in a single response
+        if (end_date - start_date).days > MAX_DAYS:
+            return {
+                "statusCode": HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                "body": json_dumps({"message": f"The date range cannot be longer than {MAX_DAYS} days."})
+            }
+
         # Subtract 1 hour from the start_date for a correct search with StartAfter
         adjusted_start_date = start_date - timedelta(hours=1)
         
@@ -146,7 +368,7 @@ def lambda_handler(event, context):
         if not isinstance(df_predictions, pd.DataFrame):
             return {
                 "statusCode": HTTPStatus.OK,
-                "body": json.dumps([])
+                "body": json_dumps([])
             }
 
         bucket_name = "air-quality-teledyne"
@@ -155,29 +377,36 @@ def lambda_handler(event, context):
         df_teledyne = get_data_as_dataframe(s3_client, bucket_name, start_filename, start_date, end_date, columns_to_keep)
 
         if isinstance(df_teledyne, pd.DataFrame):
-            df_teledyne.set_index("date", inplace=True)
-            df_predictions.set_index("date", inplace=True)
+            # Keep a single Teledyne value per date so the join does not duplicate predictions
+            df_teledyne = df_teledyne.drop_duplicates(subset="date", keep="first")
 
-            df_predictions["Teledyne_pm2.5"] = df_teledyne["PM2.5 Conc"].reindex(df_predictions.index)
+            # Join the Teledyne values on the datetime 'date' column
+            df_predictions = df_predictions.merge(
+                df_teledyne.rename(columns={"PM2.5 Conc": "Teledyne_pm2.5"}),
+                on="date",
+                how="left",
+                sort=False
+            )
 
-            df_predictions.reset_index(drop=False, inplace=True)
+        # Format the dates only for the rows of the response
+        df_predictions["date"] = df_predictions["date"].dt.strftime("%d-%m-%Y %H:%M:%S")
 
-        # Convert the DataFrame to a JSON serializable format (list of dictionaries)
-        df_predictions_serializable = df_predictions.to_dict(orient="records")
+        # Serialize the DataFrame directly to JSON (list of records), missing values become null
+        df_predictions_serialized = df_predictions.to_json(orient="records", date_format="iso", double_precision=15)
 
         ################################################################################################################################
         # with open("response_data_real_time.json", 'w') as json_file:
-        #     json.dump(df_predictions_serializable, json_file, indent=0)
+        #     json_file.write(df_predictions_serialized)
         ################################################################################################################################
         
         # Return the results as a JSON response
         return {
             "statusCode": HTTPStatus.OK,
-            "body": json.dumps(df_predictions_serializable)
+            "body": df_predictions_serialized
         }
     except Exception as e:
         return {
             "statusCode": HTTPStatus.INTERNAL_SERVER_ERROR,
-            "body": json.dumps({"error": str(e)})
+            "body": json_dumps({"error": str(e)})
         }
 # print(lambda_handler({"body": json.dumps({"start_date": "2025-03-01", "end_date": "2025-03-28"})}, None))
\ No newline at end of file
@@ -1,22 +1,53 @@
-import pandas as pd
-import joblib
 import boto3
 import json
 import jwt
 import os
+import time
+import hmac
+import base64
+import hashlib
 import io
 
 from models_configuration import model_paths
 from datetime import datetime, timedelta
+from functools import lru_cache
 from http import HTTPStatus
 
+try:
+    # orjson parses and serializes large payloads faster than the standard library
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
 # Secret key for decoding the JWT
 SECRET_KEY = os.getenv("JWT_SECRET")
 
+# HMAC-SHA256 initialized once with the secret key, it is copied to verify each token
+SECRET_KEY_HMAC = hmac.new(SECRET_KEY.encode("utf-8"), digestmod=hashlib.sha256) if SECRET_KEY is not None else None
+
+# Verify the tokens with PyJWT instead of the precomputed HMAC
+USE_PYJWT = os.getenv("USE_PYJWT", "false").lower() == "true"
+
+# Maximum number of rows predicted by a request, larger requests are rejected before loading the model
+MAX_ROWS = int(os.getenv("MAX_ROWS", "100000"))
+
 # Initialize S3 client
 s3_client = boto3.client("s3")
 
 def load_model(qhawax_id):
+    # Imported here so the requests rejected before loading a model skip the import time
+    import joblib
+
     # Check if the qhawax_id exists in the configuration
     if qhawax_id not in model_paths:
         raise ValueError(f"qhawax_id {qhawax_id} not found in the models configuration file.")
@@ -42,28 +73,122 @@ def load_model(qhawax_id):
     model = grid_search.best_estimator_
     return model
 
-def verify_token(token):
-    """Verifies the JWT token."""
+# Cache of the loaded models, reused by warm invocations
+models = dict()
+
+def get_model(qhawax_id):
+    # Load the model from disk only the first time it is requested
+    if qhawax_id not in models:
+        models[qhawax_id] = load_model(qhawax_id)
+    return models[qhawax_id]
+
+def base64url_decode(data):
+    """Decodes a base64url segment of the JWT, restoring the stripped padding."""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def get_int_claim(payload, claim):
+    """Returns the claim converted to an integer as PyJWT does, or None if it is not an integer."""
+    try:
+        return int(payload[claim])
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+def validate_time_claims(payload):
+    """Checks the iat, nbf and exp claims of the JWT payload (when present) as PyJWT does."""
+    now = time.time()
+
+    # The token is not valid yet if it was issued or starts in the future
+    for claim in ("iat", "nbf"):
+        if claim in payload:
+            value = get_int_claim(payload, claim)
+            if value is None or value > now:
+                return {"error": "Invalid token"}
+
+    if "exp" in payload:
+        exp = get_int_claim(payload, "exp")
+        if exp is None:
+            return {"error": "Invalid token"}
+        if exp <= now:
+            return {"error": "Token has expired"}
+
+    return payload
+
+def verify_token_hmac(token):
+    """Verifies the signature and the time independent claims of the HS256 JWT token with the precomputed HMAC."""
+    if SECRET_KEY_HMAC is None:
+        return {"error": "Invalid token"}
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        header_b64, payload_b64, signature_b64 = token.split(".")
+
+        # Check the signature before decoding any JSON
+        signature_hmac = SECRET_KEY_HMAC.copy()
+        signature_hmac.update(f"{header_b64}.{payload_b64}".encode("ascii"))
+        if not hmac.compare_digest(signature_hmac.digest(), base64url_decode(signature_b64)):
+            return {"error": "Invalid token"}
+
+        header = json_loads(base64url_decode(header_b64))
+        payload = json_loads(base64url_decode(payload_b64))
+    except (ValueError, UnicodeEncodeError):
+        return {"error": "Invalid token"}
+
+    if not isinstance(header, dict) or header.get("alg") != "HS256" or not isinstance(payload, dict):
+        return {"error": "Invalid token"}
+
+    # Check the sub, jti and aud claims as PyJWT does, no audience is expected so any aud is rejected
+    if "sub" in payload and not isinstance(payload["sub"], str):
+        return {"error": "Invalid token"}
+    if "jti" in payload and not isinstance(payload["jti"], str):
+        return {"error": "Invalid token"}
+    if payload.get("aud"):
+        return {"error": "Invalid token"}
+
+    return payload  # Returns the decoded payload if valid
+
+def decode_token(token):
+    """Decodes and verifies the JWT token, except for the time claims checked by verify_token."""
+    if not USE_PYJWT:
+        return verify_token_hmac(token)
+    try:
+        payload = jwt.decode(
+            token,
+            SECRET_KEY,
+            algorithms=["HS256"],
+            options={"verify_exp": False, "verify_nbf": False, "verify_iat": False}
+        )
         return payload  # Returns the decoded payload if valid
-    except jwt.ExpiredSignatureError:
-        return {"error": "Token has expired"}
     except jwt.InvalidTokenError:
         return {"error": "Invalid token"}
 
+@lru_cache(maxsize=1024)
+def decode_token_cached(token):
+    """Decodes the JWT token once per token, the payload is cached as a tuple of items."""
+    return tuple(decode_token(token).items())
+
+def verify_token(token):
+    """Verifies the JWT token."""
+    payload = dict(decode_token_cached(token))
+    if "error" in payload:
+        return payload
+    # The time claims are checked on every call, the cached token may have expired or become valid since it was first verified
+    return validate_time_claims(payload)
+
 def make_prediction(data, model):
     """Makes predictions using the model on the provided data."""
-    # Convert data to pandas DataFrame for easy processing
-    df = pd.DataFrame(data)
+    # Imported here so the requests rejected before predicting skip the import time
+    import numpy as np
 
     # Ensure that the features are available for prediction
     model_columns = ["PM25", "temperature", "humidity", "pressure"]
-    if not all(col in df.columns for col in model_columns):
+    if not data or not all(col in item for item in data for col in model_columns):
         raise ValueError("The input data is missing one or more required features.")
 
-    # Extract features
-    X = df[model_columns]
+    # Extract the features into one contiguous (n, 4) array, without intermediate per-row lists
+    # (float64, as the models were trained with)
+    X = np.fromiter(
+        (item[col] for item in data for col in model_columns),
+        dtype=np.float64,
+        count=len(model_columns) * len(data)
+    ).reshape(-1, len(model_columns))
 
     column_mapping = {
         "PM25": "Pm2.5",
@@ -72,8 +197,12 @@ def make_prediction(data, model):
         "pressure": "Presion"
     }
 
-    # Rename columns
-    X.rename(columns=column_mapping, inplace=True)
+    # The models were trained with feature names, wrap the array once with the renamed columns
+    # (copy=False reuses the array, so there is no rename or copy of the features)
+    if hasattr(model, "feature_names_in_"):
+        import pandas as pd
+
+        X = pd.DataFrame(X, columns=[column_mapping[col] for col in model_columns], copy=False)
 
     # Make predictions
     predictions = model.predict(X)
@@ -92,7 +221,7 @@ def lambda_handler(event, context):
         if not auth_header or not auth_header.startswith("Bearer "):
             return {
                 "statusCode": HTTPStatus.UNAUTHORIZED,
-                "body": json.dumps({"message": "Missing or invalid Authorization header"})
+                "body": json_dumps({"message": "Missing or invalid Authorization header"})
             }
 
         token_prefix = "Bearer "
@@ -101,7 +230,7 @@ def lambda_handler(event, context):
         if not token:
             return {
                 "statusCode": HTTPStatus.UNAUTHORIZED,
-                "body": json.dumps({"message": "Missing token in Authorization header"})
+                "body": json_dumps({"message": "Missing token in Authorization header"})
             }
 
         decoded_payload = verify_token(token)
@@ -109,23 +238,23 @@ def lambda_handler(event, context):
         if "error" in decoded_payload:
             return {
                 "statusCode": HTTPStatus.UNAUTHORIZED,
-                "body": json.dumps(decoded_payload)
+                "body": json_dumps(decoded_payload)
             }
 
         # Parse input data for prediction
         try:
-            body = json.loads(event.get("body", "{}"))
+            body = json_loads(event.get("body", "{}"))
         except json.JSONDecodeError:
             return {
                 "statusCode": HTTPStatus.BAD_REQUEST,
-                "body": json.dumps({"message": "Invalid JSON format in request body"})
+                "body": json_dumps({"message": "Invalid JSON format in request body"})
             }
 
         # Ensure required fields are present
         if "qhawax_id" not in body or "data" not in body:
             return {
                 "statusCode": HTTPStatus.BAD_REQUEST,
-                "body": json.dumps({"message": "Missing required fields: qhawax_id and data"})
+                "body": json_dumps({"message": "Missing required fields: qhawax_id and data"})
             }
 
         qhawax_id = body["qhawax_id"]
@@ -135,11 +264,18 @@ def lambda_handler(event, context):
         if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
             return {
                 "statusCode": HTTPStatus.BAD_REQUEST,
-                "body": json.dumps({"message": "Data must be a list of dictionaries"})
+                "body": json_dumps({"message": "Data must be a list of dictionaries"})
+            }
+
+        # Reject the requests with too many rows to predict
+        if len(data) > MAX_ROWS:
+            return {
+                "statusCode": HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                "body": json_dumps({"message": f"Data cannot have more than {MAX_ROWS} rows"})
             }
 
-        # Load the model based on qhawax_id
-        model = load_model(qhawax_id)
+        # Get the model based on qhawax_id
+        model = get_model(qhawax_id)
 
         # Make batch predictions
         prediction_results = make_prediction(data, model)
@@ -147,22 +283,22 @@ def lambda_handler(event, context):
         # Return prediction results in response
         return {
             "statusCode": HTTPStatus.OK,
-            "body": json.dumps({"predictions": prediction_results})
+            "body": json_dumps({"predictions": prediction_results})
         }
     except ValueError as e:
         return {
             "statusCode": HTTPStatus.BAD_REQUEST,
-            "body": json.dumps({"message": str(e)})
+            "body": json_dumps({"message": str(e)})
         }
     except FileNotFoundError as e:
         return {
             "statusCode": HTTPStatus.INTERNAL_SERVER_ERROR,
-            "body": json.dumps({"message": str(e)})
+            "body": json_dumps({"message": str(e)})
         }
     except Exception as e:
         return {
             "statusCode": HTTPStatus.INTERNAL_SERVER_ERROR,
-            "body": json.dumps({"error": str(e)})
+            "body": json_dumps({"error": str(e)})
         }
 # print(
 #     lambda_handler(